@@ -1,10 +1,11 @@
 from collections import defaultdict
+import functools
 import itertools
-from pathlib import Path
+import re
+import string
 import warnings
 
 import numpy
-from tifffile import TiffWriter
 
 import event_model
 from suitcase import tiff_stack
@@ -16,7 +17,8 @@ del get_versions
 
 
 def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
-           bigtiff=False, byteorder=None, imagej=False, **kwargs):
+           bigtiff=False, byteorder=None, imagej=False, *,
+           buffer_size=None, **kwargs):
     """
     Export a stream of documents to a series of TIFF files.
 
@@ -57,7 +59,9 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
         tifffile. The default is 16-bit integer (``'uint16'``) since many image
         viewers cannot open higher bit depths. This parameter may be given as a
         numpy dtype object (``numpy.uint32``) or the equivalent string
-        (``'uint32'``).
+        (``'uint32'``). Arrays that already have this dtype, including
+        ``numpy.memmap`` arrays, are written without being copied; other data
+        is converted one frame at a time.
 
     file_prefix : str, optional
         The first part of the filename of the generated output files. This
@@ -80,8 +84,16 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
     imagej: boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
 
+    buffer_size : int or None, optional
+        Size in bytes of the write buffer of each output file. By default
+        1 MiB, or 4 MiB if ``bigtiff`` is True.
+
     **kwargs : kwargs
-        kwargs to be passed to ``tifffile.TiffWriter.write``.
+        kwargs to be passed to ``tifffile.TiffWriter.write``, such as
+        ``compression='zlib'``. When compressing, tifffile chooses how many
+        threads to encode with from the segment size, unless ``maxworkers``
+        is given. Compressed frames of at least 1024 x 1024 pixels are tiled
+        unless ``tile`` is given.
 
     Returns
     -------
@@ -106,12 +118,17 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
     Place the files in a different directory, such as on a mounted USB stick.
 
     >>> export(gen, '/path/to/my_usb_stick')
+
+    Compress the images, encoding with up to four threads.
+
+    >>> export(gen, '', compression='zlib', maxworkers=4)
     """
     with Serializer(directory, file_prefix,
                     astype=astype,
                     bigtiff=bigtiff,
                     byteorder=byteorder,
                     imagej=imagej,
+                    buffer_size=buffer_size,
                     **kwargs) as serializer:
         for item in gen:
             serializer(*item)
@@ -174,7 +191,9 @@ class Serializer(tiff_stack.Serializer):
         tifffile. The default is 16-bit integer (``'uint16'``) since many image
         viewers cannot open higher bit depths. This parameter may be given as a
         numpy dtype object (``numpy.uint32``) or the equivalent string
-        (``'uint32'``).
+        (``'uint32'``). Arrays that already have this dtype, including
+        ``numpy.memmap`` arrays, are written without being copied; other data
+        is converted one frame at a time.
 
     bigtiff : boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
@@ -185,26 +204,78 @@ class Serializer(tiff_stack.Serializer):
     imagej: boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
 
+    buffer_size : int or None, optional
+        Size in bytes of the write buffer of each output file. By default
+        1 MiB, or 4 MiB if ``bigtiff`` is True.
+
     event_num_pad : int, optional
         The number of 0s to left-pad the event number to in the filename.
 
     **kwargs : kwargs
-        kwargs to be passed to ``tifffile.TiffWriter.write``.
+        kwargs to be passed to ``tifffile.TiffWriter.write``, such as
+        ``compression='zlib'``. When compressing, tifffile chooses how many
+        threads to encode with from the segment size, unless ``maxworkers``
+        is given. Compressed frames of at least 1024 x 1024 pixels are tiled
+        unless ``tile`` is given.
     """
+
+    # Each frame is written to its own file.
+    _stacks_frames = False
+
     def __init__(
             self, directory, file_prefix='{start[uid]}-', astype='uint16',
             bigtiff=False, byteorder=None, imagej=False, *,
-            event_num_pad=5, **kwargs
+            buffer_size=None, event_num_pad=5, **kwargs
     ):
         super().__init__(directory, file_prefix=file_prefix, astype=astype,
                          bigtiff=bigtiff, byteorder=byteorder, imagej=imagej,
-                         **kwargs)
-        # maps stream name to dict that map field name to index (#)
-        self._counter = defaultdict(lambda: defaultdict(itertools.count))
+                         buffer_size=buffer_size, **kwargs)
+        # maps (stream name, field) to index (#)
+        self._counter = defaultdict(itertools.count)
         self._event_num_pad = event_num_pad
+        # maps descriptor uid to {field: (stream name, shape, counter)} for
+        # the image fields, so each image needs a single lookup
+        self._image_fields = {}
+        # maps descriptor uid to file_prefix with start/descriptor filled in
+        self._file_prefixes = {}
+        # maps descriptor uid to {field: fully formatted file_prefix}, for
+        # descriptors whose file_prefix does not depend on the Event
+        self._templated_file_prefixes = {}
+
+    def descriptor(self, doc):
+        '''Record the descriptor and pre-format ``file_prefix`` for it.
+
+        If the stream has image fields, everything in ``file_prefix`` that
+        is fixed for the stream is formatted here once, so that only the
+        per-Event parts, if any, are formatted for each Event. Streams
+        without images never use ``file_prefix``, so it is not formatted.
+
+        Parameters:
+        -----------
+        doc : dict
+            EventDescriptor document
+        '''
+        super().descriptor(doc)
+        stream_name = doc.get('name')
+        self._image_fields[doc['uid']] = {
+            field: (stream_name, shape, self._counter[stream_name, field])
+            for field, shape in self._image_shapes[doc['uid']].items()}
+        if not self._image_fields[doc['uid']]:
+            return
+        file_prefix = _partial_format(
+            self._file_prefix, start=self._start, descriptor=doc,
+            stream_name=doc.get('name'))
+        self._file_prefixes[doc['uid']] = file_prefix
+        if 'event' not in _field_names(file_prefix):
+            self._templated_file_prefixes[doc['uid']] = {
+                field: file_prefix.format(field=field)
+                for field in self._image_shapes[doc['uid']]}
 
     def event_page(self, doc):
-        '''Converts an 'event_page' doc to 'event' docs for processing.
+        '''Add the images in an 'event_page' doc to ".tiff" files.
+
+        Unless ``file_prefix`` refers to the Event, the page is not unpacked
+        into Event documents; the image columns are walked row by row.
 
         Parameters:
         -----------
@@ -212,9 +283,23 @@ class Serializer(tiff_stack.Serializer):
             Event_Page document
         '''
 
-        events = event_model.unpack_event_page(doc)
-        for event_doc in events:
-            self.event(event_doc)
+        # Verify the whole page once instead of re-packing every event.
+        event_model.verify_filled(doc)
+        if not self._image_fields[doc['descriptor']]:
+            return
+        templated_file_prefixes = self._templated_file_prefixes.get(
+            doc['descriptor'])
+        if templated_file_prefixes is None:
+            # The file names depend on the Event, so each one is needed.
+            for event_doc in event_model.unpack_event_page(doc):
+                self._write_event(event_doc)
+            return
+        for field in self._image_shapes[doc['descriptor']]:
+            if field not in doc['data']:
+                continue
+            for img in doc['data'][field]:
+                self._write_image(doc['descriptor'], field, img,
+                                  templated_file_prefixes[field])
 
     def event(self, doc):
         '''Add event document information to a ".tiff" file.
@@ -241,46 +326,93 @@ class Serializer(tiff_stack.Serializer):
         doc : dict
             Event document
         '''
-        event_model.verify_filled(event_model.pack_event_page(*[doc]))
-        descriptor = self._descriptors[doc['descriptor']]
-        stream_name = descriptor.get('name')
-        for field in doc['data']:
-            img = doc['data'][field]
-            # Check that the data is 2D or 3D; if not ignore it.
-            data_key = descriptor['data_keys'][field]
-            ndim = len(data_key['shape'] or [])
-            if data_key['dtype'] == 'array' and 1 < ndim < 4:
-                img_asarray = numpy.asarray(img, dtype=self._astype)
-                if tuple(data_key['shape']) != img_asarray.shape:
-                    warnings.warn(
-                        f"The descriptor claims the data shape is {data_key['shape']} "
-                        f"but the data is actual data shape is {img_asarray.shape}! "
-                        f"This will be an error in the future."
-                    )
-                    ndim = img_asarray.ndim
-
-                if ndim == 2:
-                    # handle 2D data just like 3D data
-                    # by adding a 3rd dimension
-                    img_asarray = numpy.expand_dims(img_asarray, axis=0)
-                for i in range(img_asarray.shape[0]):
-                    img_asarray_2d = img_asarray[i, :]
-                    num = next(self._counter[stream_name][field])
-                    filename = get_prefixed_filename(
-                        file_prefix=self._file_prefix,
-                        start_doc=self._start,
-                        descriptor_doc=descriptor,
-                        event_doc=doc,
-                        num=num,
-                        stream_name=stream_name,
-                        field=field,
-                        pad=self._event_num_pad
-                    )
-                    fname = self._manager.reserve_name('stream_data', filename)
-                    Path(fname).parent.mkdir(parents=True, exist_ok=True)
-                    tw = TiffWriter(fname, **self._init_kwargs)
-                    self._tiff_writers[stream_name][field+f'-{num}'] = tw
-                    tw.write(img_asarray_2d, *self._kwargs)
+        # The same check as event_model.verify_filled, without packing the
+        # Event into an EventPage first.
+        unfilled = [field for field, filled in doc.get('filled', {}).items()
+                    if not filled]
+        if unfilled:
+            raise event_model.UnfilledData(
+                f"Unfilled data found in fields {unfilled!r}. Use "
+                f"`event_model.Filler`.")
+        self._write_event(doc)
+
+    def _write_event(self, doc):
+        '''Write the images in an Event document that is known to be filled.
+
+        Parameters:
+        -----------
+        doc : dict
+            Event document
+        '''
+        if not self._image_fields[doc['descriptor']]:
+            return
+        file_prefix = self._file_prefixes[doc['descriptor']]
+        templated_file_prefixes = self._templated_file_prefixes.get(
+            doc['descriptor'], {})
+        # Only 2D or 3D data is written; all other fields are ignored.
+        for field in self._image_shapes[doc['descriptor']]:
+            if field not in doc['data']:
+                continue
+            templated_file_prefix = templated_file_prefixes.get(field)
+            if templated_file_prefix is None:
+                templated_file_prefix = file_prefix.format(event=doc,
+                                                           field=field)
+            self._write_image(doc['descriptor'], field, doc['data'][field],
+                              templated_file_prefix)
+
+    def _write_image(self, descriptor_uid, field, img, templated_file_prefix):
+        '''Write each frame of a 2D or 3D image to its own file.
+
+        Parameters:
+        -----------
+        descriptor_uid : str
+            The uid of the descriptor of the Event the image belongs to.
+        field : str
+            The field the image belongs to.
+        img : array-like
+            The image.
+        templated_file_prefix : str
+            The fully formatted file_prefix.
+        '''
+        stream_name, shape, counter = self._image_fields[descriptor_uid][field]
+        ndim = len(shape)
+        # This does not copy arrays. The conversion to astype is done
+        # frame by frame into reused buffers by _asarray.
+        img_asarray = numpy.asarray(img)
+        if shape != img_asarray.shape:
+            warnings.warn(
+                f"The descriptor claims the data shape is {list(shape)} "
+                f"but the data is actual data shape is {img_asarray.shape}! "
+                f"This will be an error in the future."
+            )
+            ndim = img_asarray.ndim
+
+        # 2D data is a single frame, 3D data is a stack of frames.
+        frames = img_asarray if ndim == 3 else (img_asarray,)
+        for img_asarray_2d in frames:
+            img_asarray_2d = self._asarray(
+                (stream_name, field), img_asarray_2d)
+            num = next(counter)
+            filename = _filename(templated_file_prefix, stream_name,
+                                 field, num, self._event_num_pad)
+            # Each file holds exactly one frame, so finish it now
+            # rather than holding one open file per frame until
+            # close(). Use tiff_stack for multi-page files.
+            tw, file = self._open_tiff_writer(filename)
+            self._submit(
+                functools.partial(self._write_file, tw, file, img_asarray_2d,
+                                  self._frame_kwargs(img_asarray_2d.shape)),
+                skipped=functools.partial(self._close_file, tw, file))
+
+    def _write_file(self, tw, file, img, kwargs):
+        '''Write ``img`` as the only frame of a file, then close it.'''
+        with file, tw:
+            tw.write(img, **kwargs)
+
+    def _close_file(self, tw, file):
+        '''Close a file whose write was skipped after an earlier failure.'''
+        with file, tw:
+            pass
 
 
 def get_prefixed_filename(
@@ -300,6 +432,46 @@ def get_prefixed_filename(
         stream_name=stream_name,
         field=field
     )
-    filename = (f'{templated_file_prefix}'
-                f'{stream_name}-{field}-{num:0{pad}d}.tiff')
-    return filename
+    return _filename(templated_file_prefix, stream_name, field, num, pad)
+
+
+def _filename(templated_file_prefix, stream_name, field, num, pad):
+    '''Assemble the filename from an already formatted file_prefix.'''
+    return f'{templated_file_prefix}{stream_name}-{field}-{num:0{pad}d}.tiff'
+
+
+def _partial_format(template, **kwargs):
+    '''Format only the fields of ``template`` that are named in ``kwargs``.
+
+    Any other fields, and escaped braces, are left as they are so that the
+    result can be formatted again with the remaining fields.
+    '''
+    formatter = string.Formatter()
+    parts = []
+    for literal, field_name, spec, conversion in formatter.parse(template):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field_name is None:
+            continue
+        name = _field_name(field_name)
+        if name in kwargs and '{' not in spec:
+            obj, _ = formatter.get_field(field_name, (), kwargs)
+            obj = formatter.convert_field(obj, conversion)
+            value = formatter.format_field(obj, spec)
+            parts.append(value.replace('{', '{{').replace('}', '}}'))
+        else:
+            conversion = f'!{conversion}' if conversion else ''
+            spec = f':{spec}' if spec else ''
+            parts.append(f'{{{field_name}{conversion}{spec}}}')
+    return ''.join(parts)
+
+
+def _field_name(field_name):
+    '''Return the argument name of a format field, e.g. start for start[uid].'''
+    return re.split(r'[.\[]', field_name, maxsplit=1)[0]
+
+
+def _field_names(template):
+    '''Return the argument names of the fields in ``template``.'''
+    return {_field_name(field_name)
+            for _, field_name, _, _ in string.Formatter().parse(template)
+            if field_name is not None}
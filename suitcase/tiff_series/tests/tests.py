@@ -3,6 +3,7 @@ import itertools
 import os
 from pathlib import Path
 import re
+import sys
 
 import numpy as np
 from numpy.testing import assert_array_equal
@@ -60,7 +61,9 @@ def create_expected(collector, stack_images):
 @pytest.mark.parametrize("file_prefix", ['test-', 'scan_{start[uid]}-',
                                          'scan_{descriptor[uid]}-',
                                          '{event[uid]}-',
-                                         '{stream_name}_{field}-'])
+                                         '{stream_name}_{field}-',
+                                         '{start[time]:.0f}-{descriptor[name]!s}-',
+                                         '{descriptor[hints][direct][fields][0]}-'])
 def test_path_formatting(file_prefix, example_data, tmp_path):
     collector = example_data()
     artifacts = export(collector, tmp_path, file_prefix=file_prefix)
@@ -245,3 +248,188 @@ def test_2d_data_lies(RE, tmp_path):
     filenames = os.listdir(path=tmp_path)
     assert len(filenames) == 5
     assert all([re.search(r"-\d+\.tiff$", filename) for filename in filenames])
+
+
+def test_kwargs_passed_to_write(RE, tmp_path):
+    """
+    Expect the extra kwargs to reach ``tifffile.TiffWriter.write``.
+    """
+    def return_2d_data():
+        return np.ones((3, 3))
+
+    det = DirectImage(name="2d_image", func=return_2d_data)
+
+    tiff_serializer = Serializer(directory=tmp_path, compression='zlib')
+    RE.subscribe(tiff_serializer)
+    RE(count([det], num=2))
+
+    for filename in tiff_serializer.artifacts["stream_data"]:
+        with tifffile.TiffFile(filename) as tif:
+            assert tif.pages[0].compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+        assert_array_equal(tifffile.imread(filename), np.ones((3, 3)))
+
+
+@pytest.mark.parametrize("name", ['event', 'event_page'])
+def test_unfilled(name, tmp_path):
+    """
+    Expect an error and no file written for an unfilled Event or EventPage.
+    """
+    run_bundle = event_model.compose_run()
+    data_keys = {'img': {'source': '', 'dtype': 'array', 'shape': [3, 3],
+                         'external': 'FILESTORE:'}}
+    desc_bundle = run_bundle.compose_descriptor(
+        data_keys=data_keys, name='primary')
+    if name == 'event':
+        doc = desc_bundle.compose_event(
+            data={'img': 'datum-id'}, timestamps={'img': 0}, seq_num=1,
+            filled={'img': False})
+    else:
+        doc = desc_bundle.compose_event_page(
+            data={'img': ['datum-id']}, timestamps={'img': [0]},
+            seq_num=[1], filled={'img': [False]})
+
+    with Serializer(directory=tmp_path) as tiff_serializer:
+        tiff_serializer('start', run_bundle.start_doc)
+        tiff_serializer('descriptor', desc_bundle.descriptor_doc)
+        with pytest.raises(event_model.UnfilledData, match="'img'"):
+            tiff_serializer(name, doc)
+
+    assert os.listdir(path=tmp_path) == []
+
+
+def test_converted_frames_not_overwritten(RE, tmp_path):
+    """
+    Expect every frame that needs a dtype conversion to be written intact.
+    """
+    def return_3d_data():
+        return np.arange(10 * 3 * 3, dtype=float).reshape((10, 3, 3))
+
+    det = DirectImage(name="3d_image", func=return_3d_data)
+
+    tiff_serializer = Serializer(directory=tmp_path)
+    RE.subscribe(tiff_serializer)
+    RE(count([det], num=2))
+
+    filenames = sorted(tiff_serializer.artifacts["stream_data"])
+    assert len(filenames) == 20
+    expected = np.concatenate([return_3d_data()] * 2).astype('uint16')
+    for filename, frame in zip(filenames, expected):
+        assert_array_equal(tifffile.imread(filename), frame)
+
+
+@pytest.mark.parametrize("kwargs, buffer_size",
+                         [({'bigtiff': True}, 4 * 2**20),
+                          ({'buffer_size': 12345}, 12345)])
+def test_buffer_size(kwargs, buffer_size, RE, tmp_path, monkeypatch):
+    """
+    Expect every file to be opened with the requested write buffer size.
+    """
+    buffer_sizes = []
+
+    def recording_open(*args, buffering=-1, **kwargs):
+        buffer_sizes.append(buffering)
+        return open(*args, buffering=buffering, **kwargs)
+
+    # The files are opened by the tiff_stack Serializer's methods.
+    module = sys.modules[Serializer._open_tiff_writer.__module__]
+    monkeypatch.setattr(module, 'open', recording_open, raising=False)
+    det = DirectImage(name="2d_image", func=lambda: np.ones((3, 3)))
+    tiff_serializer = Serializer(directory=tmp_path, **kwargs)
+    RE.subscribe(tiff_serializer)
+    RE(count([det], num=2))
+
+    assert buffer_sizes == [buffer_size] * 2
+
+
+def test_imagej_compression(RE, tmp_path):
+    """
+    Expect ImageJ files to be compressed, as each holds a single frame.
+    """
+    det = DirectImage(name="2d_image", func=lambda: np.ones((3, 3)))
+    tiff_serializer = Serializer(directory=tmp_path, imagej=True,
+                                 compression='zlib')
+    RE.subscribe(tiff_serializer)
+    RE(count([det], num=2))
+
+    filenames = tiff_serializer.artifacts["stream_data"]
+    assert len(filenames) == 2
+    for filename in filenames:
+        with tifffile.TiffFile(filename) as tif:
+            assert tif.is_imagej
+            assert tif.pages[0].compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+            assert_array_equal(tif.asarray(), np.ones((3, 3)))
+
+
+def test_export_twice(RE, tmp_path):
+    """
+    Expect exporting again with a fixed prefix to overwrite the files.
+    """
+    for value in (1, 2):
+        det = DirectImage(name="2d_image",
+                          func=lambda: np.full((3, 3), value))
+        tiff_serializer = Serializer(directory=tmp_path, file_prefix='fixed-')
+        token = RE.subscribe(tiff_serializer)
+        RE(count([det], num=2))
+        RE.unsubscribe(token)
+
+    filenames = tiff_serializer.artifacts["stream_data"]
+    assert len(filenames) == 2
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(filename) for filename in filenames)
+    for filename in filenames:
+        assert_array_equal(tifffile.imread(filename), np.full((3, 3), 2))
+
+
+@pytest.mark.parametrize("dtype", ['uint8', 'int32', 'float32'])
+def test_astype_none(dtype, RE, tmp_path):
+    """
+    Expect frames to keep their dtype if astype is None.
+    """
+    def return_2d_data():
+        return np.arange(3 * 3, dtype=dtype).reshape((3, 3))
+
+    det = DirectImage(name="2d_image", func=return_2d_data)
+
+    tiff_serializer = Serializer(directory=tmp_path, astype=None)
+    RE.subscribe(tiff_serializer)
+    RE(count([det], num=2))
+
+    filenames = tiff_serializer.artifacts["stream_data"]
+    assert len(filenames) == 2
+    for filename in filenames:
+        actual = tifffile.imread(filename)
+        assert actual.dtype == dtype
+        assert_array_equal(actual, return_2d_data())
+
+
+def test_write_error_is_sticky(tmp_path):
+    """
+    Expect a failed write to fail every later Event and close(), and the
+    file of the failed write to be closed.
+    """
+    run_bundle = event_model.compose_run()
+    data_keys = {'img': {'source': '', 'dtype': 'array', 'shape': [3, 3]}}
+    desc_bundle = run_bundle.compose_descriptor(
+        data_keys=data_keys, name='primary')
+
+    def make_event(seq_num):
+        return desc_bundle.compose_event(
+            data={'img': np.ones((3, 3))}, timestamps={'img': 0},
+            seq_num=seq_num)
+
+    tiff_serializer = Serializer(directory=tmp_path,
+                                 compression='not-a-codec')
+    tiff_serializer('start', run_bundle.start_doc)
+    tiff_serializer('descriptor', desc_bundle.descriptor_doc)
+    tiff_serializer('event', make_event(1))
+    # close() waits for the queued write, so the error is known after it.
+    with pytest.raises(ValueError, match="COMPRESSION"):
+        tiff_serializer.close()
+    for seq_num in range(2, 5):
+        with pytest.raises(ValueError, match="COMPRESSION"):
+            tiff_serializer('event', make_event(seq_num))
+    with pytest.raises(ValueError, match="COMPRESSION"):
+        tiff_serializer.close()
+
+    filename, = tiff_serializer.artifacts["stream_data"]
+    assert os.path.getsize(filename) > 0
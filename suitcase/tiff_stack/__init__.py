@@ -1,5 +1,10 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
 from pathlib import Path
+import queue
+import threading
 
 import numpy
 from tifffile import TiffWriter
@@ -14,7 +19,8 @@ del get_versions
 
 
 def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
-           bigtiff=False, byteorder=None, imagej=False, **kwargs):
+           bigtiff=False, byteorder=None, imagej=False, *,
+           buffer_size=None, **kwargs):
     """
     Export a stream of documents to TIFF stack(s).
 
@@ -67,7 +73,9 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
         tifffile. The default is 16-bit integer (``'uint16'``) since many image
         viewers cannot open higher bit depths. This parameter may be given as a
         numpy dtype object (``numpy.uint32``) or the equivalent string
-        (``'uint32'``).
+        (``'uint32'``). Arrays that already have this dtype, including
+        ``numpy.memmap`` arrays, are written without being copied; other data
+        is converted one frame at a time.
 
     bigtiff : boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
@@ -78,8 +86,16 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
     imagej: boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
 
+    buffer_size : int or None, optional
+        Size in bytes of the write buffer of each output file. By default
+        1 MiB, or 4 MiB if ``bigtiff`` is True.
+
     **kwargs : kwargs
-        kwargs to be passed to ``tifffile.TiffWriter.write``.
+        kwargs to be passed to ``tifffile.TiffWriter.write``, such as
+        ``compression='zlib'``. When compressing, tifffile chooses how many
+        threads to encode with from the segment size, unless ``maxworkers``
+        is given. Compressed frames of at least 1024 x 1024 pixels are tiled
+        unless ``tile`` is given.
 
     Returns
     -------
@@ -104,12 +120,17 @@ def export(gen, directory, file_prefix='{start[uid]}-', astype='uint16',
     Place the files in a different directory, such as on a mounted USB stick.
 
     >>> export(gen, '/path/to/my_usb_stick')
+
+    Compress the images, encoding with up to four threads.
+
+    >>> export(gen, '', compression='zlib', maxworkers=4)
     """
     with Serializer(directory, file_prefix,
                     astype=astype,
                     bigtiff=bigtiff,
                     byteorder=byteorder,
                     imagej=imagej,
+                    buffer_size=buffer_size,
                     **kwargs) as serializer:
         for item in gen:
             serializer(*item)
@@ -168,7 +189,9 @@ class Serializer(event_model.DocumentRouter):
         tifffile. The default is 16-bit integer (``'uint16'``) since many image
         viewers cannot open higher bit depths. This parameter may be given as a
         numpy dtype object (``numpy.uint32``) or the equivalent string
-        (``'uint32'``).
+        (``'uint32'``). Arrays that already have this dtype, including
+        ``numpy.memmap`` arrays, are written without being copied; other data
+        is converted one frame at a time.
 
     bigtiff : boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
@@ -179,34 +202,85 @@ class Serializer(event_model.DocumentRouter):
     imagej: boolean, optional
         Passed into ``tifffile.TiffWriter``. Default False.
 
+    buffer_size : int or None, optional
+        Size in bytes of the write buffer of each output file. By default
+        1 MiB, or 4 MiB if ``bigtiff`` is True.
+
     **kwargs : kwargs
-        kwargs to be passed to ``tifffile.TiffWriter.write``.
+        kwargs to be passed to ``tifffile.TiffWriter.write``, such as
+        ``compression='zlib'``. When compressing, tifffile chooses how many
+        threads to encode with from the segment size, unless ``maxworkers``
+        is given. Compressed frames of at least 1024 x 1024 pixels are tiled
+        unless ``tile`` is given. Compression cannot be combined with
+        ``imagej``, which needs the frames of a stack in one series.
     """
 
+    # All the frames of a field are written to one file.
+    _stacks_frames = True
+
     def __init__(self, directory, file_prefix='{start[uid]}-', astype='uint16',
-                 bigtiff=False, byteorder=None, imagej=False, **kwargs):
+                 bigtiff=False, byteorder=None, imagej=False, *,
+                 buffer_size=None, **kwargs):
 
         if isinstance(directory, (str, Path)):
             self._manager = suitcase.utils.MultiFileManager(directory)
         else:
             self._manager = directory
 
-        # Map stream name to dict that maps field names to TiffWriter objects.
-        self._tiff_writers = defaultdict(dict)
+        # Map (stream name, field) to TiffWriter objects.
+        self._tiff_writers = {}
 
         self._file_prefix = file_prefix
         self._astype = astype  # convert numpy array dtype before tifffile
         self._init_kwargs = {'bigtiff': bigtiff, 'byteorder': byteorder,
                              'imagej': imagej}  # passed to TiffWriter()
+        _check_write_kwargs(kwargs)
         self._kwargs = kwargs  # passed to TiffWriter.write()
+        # tifffile can only append frames to the previous page's series when
+        # they are neither compressed nor tiled. Otherwise every frame gets
+        # its own page, and the per-series metadata is turned off so that
+        # readers still see the pages as one stack.
+        self._contiguous = (kwargs.get('compression') in (None, False, 1, 'none')
+                            and kwargs.get('tile') is None)
+        if imagej and self._stacks_frames and not self._contiguous:
+            # tifffile would only fail on the second frame, in close().
+            raise ValueError(
+                "The ImageJ format does not support compressed or tiled "
+                "stacks. Pass imagej=False or drop 'compression' and 'tile'.")
+        # Large compressed frames are tiled unless a tile shape is given, so
+        # that readers can decode regions of them independently.
+        self._auto_tile = (not self._contiguous and 'tile' not in kwargs
+                           and not imagej)
+        # (stream name, field) pairs with a first frame written.
+        self._appending = set()
+        if buffer_size is None:
+            buffer_size = 4 * 2**20 if bigtiff else 2**20
+        self._buffer_size = buffer_size  # passed to open()
+        # Map (stream name, field) to the file handles under the TiffWriters.
+        self._files = {}
+        self._artifacts = defaultdict(list)  # maps labels to artifacts
+        self._directories = set()  # directories known to exist
+        # Images are written on a background thread so that encoding and
+        # disk I/O overlap with the production of the next documents. The
+        # bounded queue holds back the producer if writing falls behind.
+        self._queue = queue.Queue(maxsize=4)
+        self._writer_thread = None  # started on the first write
+        self._writer_error = None  # re-raised here until close() is done
+        # Maps (stream name, field) to a ring of buffers used to convert
+        # frames to astype, see _asarray.
+        self._staging = defaultdict(deque)
         self._start = None  # holds the start document information
         self._descriptors = {}  # maps the descriptor uids to descriptor docs.
+        # maps the descriptor uids to {field: shape} for the fields that hold
+        # 2D or 3D 'image like' data, which are the only ones written.
+        self._image_shapes = {}
 
     @property
     def artifacts(self):
-        # The manager's artifacts attribute is itself a property, and we must
-        # access it a new each time to be sure to get the latest content.
-        return self._manager.artifacts
+        # The manager's artifacts property rebuilds its dict from every
+        # artifact in a Python loop on each access, and tiff_series makes
+        # one artifact per frame, so keep our own record instead.
+        return {label: list(names) for label, names in self._artifacts.items()}
 
     def start(self, doc):
         '''Extracts `start` document information for formatting file_prefix.
@@ -241,6 +315,11 @@ class Serializer(event_model.DocumentRouter):
         '''
         # record the doc for later use
         self._descriptors[doc['uid']] = doc
+        self._image_shapes[doc['uid']] = {
+            field: tuple(data_key['shape'])
+            for field, data_key in doc['data_keys'].items()
+            if data_key['dtype'] == 'array'
+            and 1 < len(data_key['shape'] or []) < 4}
 
     def event_page(self, doc):
         '''Add event page document information to a ".tiff" file.
@@ -269,38 +348,178 @@ class Serializer(event_model.DocumentRouter):
         event_model.verify_filled(doc)
         descriptor = self._descriptors[doc['descriptor']]
         stream_name = descriptor.get('name')
-        for field in doc['data']:
+        # Only 2D or 3D data is written; all other fields are ignored.
+        for field, shape in self._image_shapes[doc['descriptor']].items():
+            if field not in doc['data']:
+                continue
+            ndim = len(shape)
+            key = (stream_name, field)
+            tw = self._tiff_writers.get(key)
             for img in doc['data'][field]:
-                # Check that the data is 2D or 3D; if not ignore it.
-                data_key = descriptor['data_keys'][field]
-                ndim = len(data_key['shape'] or [])
-                if data_key['dtype'] == 'array' and 1 < ndim < 4:
+                # This does not copy arrays. The conversion to astype is done
+                # frame by frame into reused buffers by _asarray.
+                img_asarray = numpy.asarray(img)
+                # 2D data is a single frame, 3D data is a stack of frames.
+                frames = img_asarray if ndim == 3 else (img_asarray,)
+                for img_asarray_2d in frames:
                     # there is data to be written so
                     # create a file for this stream and field
                     # if one does not exist yet
-                    if not self._tiff_writers.get(stream_name, {}).get(field):
+                    if tw is None:
                         filename = get_prefixed_filename(
                             file_prefix=self._file_prefix,
                             start_doc=self._start,
                             stream_name=stream_name,
                             field=field
                         )
-                        fname = self._manager.reserve_name('stream_data', filename)
-                        Path(fname).parent.mkdir(parents=True, exist_ok=True)
-                        tw = TiffWriter(fname, **self._init_kwargs)
-                        self._tiff_writers[stream_name][field] = tw
-
-                    # write the data
-                    img_asarray = numpy.asarray(img, dtype=self._astype)
-                    if ndim == 2:
-                        # handle 2D data just like 3D data
-                        # by adding a 3rd dimension
-                        img_asarray = numpy.expand_dims(img_asarray, axis=0)
-                    for i in range(img_asarray.shape[0]):
-                        img_asarray_2d = img_asarray[i, :]
-                        # append the image to the file
-                        tw = self._tiff_writers[stream_name][field]
-                        tw.write(img_asarray_2d, contiguous=True, *self._kwargs)
+                        tw, file = self._open_tiff_writer(filename)
+                        self._tiff_writers[key] = tw
+                        self._files[key] = file
+                    img_asarray_2d = self._asarray(key, img_asarray_2d)
+                    # append the image to the file
+                    self._submit(functools.partial(
+                        tw.write, img_asarray_2d,
+                        **self._write_kwargs(key, img_asarray_2d.shape)))
+
+    def _open_tiff_writer(self, filename):
+        '''Create a TiffWriter writing to a new buffered file.
+
+        TiffWriter issues many small writes (tags, offsets, IFDs), so the
+        file is opened with a large buffer to coalesce them into fewer
+        system calls.
+
+        Parameters:
+        -----------
+        filename : str
+            The file name, relative to the manager's directory.
+
+        Returns:
+        --------
+        tw, file : TiffWriter, file handle
+            The caller is responsible for closing ``tw`` and then ``file``.
+        '''
+        # Do not start new files once a write has failed.
+        self._raise_writer_error()
+        fname = self._manager.reserve_name('stream_data', filename)
+        self._artifacts['stream_data'].append(fname)
+        # tiff_series opens a file per frame, usually all in one directory,
+        # so only create each directory once.
+        directory = Path(fname).parent
+        if directory not in self._directories:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._directories.add(directory)
+        # Like TiffWriter given a path, overwrite existing files.
+        file = open(fname, 'wb', buffering=self._buffer_size)
+        return TiffWriter(file, **self._init_kwargs), file
+
+    def _write_kwargs(self, key, shape):
+        '''Return the kwargs for writing the next frame of ``key``.
+
+        In contiguous mode, only the first frame needs the user's kwargs;
+        the frames after it are appended as raw image data.
+
+        Parameters:
+        -----------
+        key : tuple
+            The (stream name, field) that the frame belongs to.
+        shape : tuple
+            The shape of the frame.
+        '''
+        if not self._contiguous:
+            return {'metadata': None, **self._frame_kwargs(shape)}
+        if key in self._appending:
+            return {'contiguous': True}
+        self._appending.add(key)
+        return {'contiguous': True, **self._kwargs}
+
+    def _frame_kwargs(self, shape):
+        '''Return the user's kwargs plus a default tile for ``shape``.'''
+        if self._auto_tile:
+            tile = _default_tile(shape)
+            if tile is not None:
+                return {'tile': tile, **self._kwargs}
+        return self._kwargs
+
+    def _asarray(self, key, frame):
+        '''Return the array ``frame`` converted to ``astype``.
+
+        Frames are returned as they are if ``astype`` is None or they already
+        have that dtype. Others are copied into a buffer from a ring kept for
+        ``key``, instead of a newly allocated array for every frame. Each frame is submitted to
+        the writer thread once, and at most ``maxsize + 1`` submitted frames
+        are pending, so a ring of ``maxsize + 2`` buffers is never reused
+        while a pending write still refers to it.
+
+        Parameters:
+        -----------
+        key : tuple
+            The (stream name, field) that ``frame`` belongs to.
+        frame : numpy.ndarray
+            A 2D image.
+        '''
+        if self._astype is None or frame.dtype == self._astype:
+            return frame
+        ring = self._staging[key]
+        if ring and ring[-1].shape != frame.shape:
+            ring.clear()
+        if len(ring) < self._queue.maxsize + 2:
+            buffer = numpy.empty(frame.shape, dtype=self._astype)
+        else:
+            buffer = ring.popleft()
+        ring.append(buffer)
+        numpy.copyto(buffer, frame, casting='unsafe')
+        return buffer
+
+    def _submit(self, task, skipped=None):
+        '''Queue ``task()`` to run on the writer thread.
+
+        The arrays passed in must not be modified afterwards, as they may be
+        written after this returns.
+
+        Parameters:
+        -----------
+        task : callable
+            The write to run.
+        skipped : callable, optional
+            Run instead of ``task`` if an earlier write failed, to release
+            anything that ``task`` would have closed.
+        '''
+        if self._writer_error is not None and skipped is not None:
+            skipped()
+        self._raise_writer_error()
+        if self._writer_thread is None:
+            self._writer_thread = threading.Thread(target=self._drain,
+                                                   daemon=True)
+            self._writer_thread.start()
+        self._queue.put((task, skipped))
+
+    def _drain(self):
+        '''Run the queued writes until ``None`` is received.
+
+        After a write fails, the error is kept, to be raised by every later
+        ``_submit`` and by ``close``, and the writes already queued are
+        skipped.
+        '''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            task, skipped = item
+            if self._writer_error is not None:
+                task = skipped
+            if task is None:
+                continue
+            try:
+                task()
+            except Exception as err:
+                # Keep the first error; it is the one that matters.
+                if self._writer_error is None:
+                    self._writer_error = err
+
+    def _raise_writer_error(self):
+        '''Raise the error from the writer thread, if a write has failed.'''
+        if self._writer_error is not None:
+            raise self._writer_error
 
     def stop(self, doc):
         self.close()
@@ -308,13 +527,36 @@ class Serializer(event_model.DocumentRouter):
     def close(self):
         '''Close all of the files opened by this Serializer.
         '''
-        # Close all the TiffWriter instances, which do some work on cleanup.
-        for tw_by_stream in self._tiff_writers.values():
-            for tw in tw_by_stream.values():
-                tw.close()
-        # Then let the manager (perhaps redundantly) close the underlying
-        # files.
-        self._manager.close()
+        # Wait for the queued writes to finish before closing anything.
+        if self._writer_thread is not None:
+            self._queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+        # Close all the TiffWriter instances, which do some work on cleanup,
+        # and their files. Each writes to its own file, so they are closed
+        # concurrently to overlap the final writes and flushes.
+        try:
+            if self._tiff_writers:
+                max_workers = min(32, len(self._tiff_writers))
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(self._close_tiff_writer,
+                                      self._tiff_writers))
+        except Exception:
+            # A failed write is usually what broke the close, so raise that.
+            self._raise_writer_error()
+            raise
+        finally:
+            # Then let the manager (perhaps redundantly) close the
+            # underlying files.
+            self._manager.close()
+        self._raise_writer_error()
+
+    def _close_tiff_writer(self, key):
+        '''Close the TiffWriter for ``key`` and then its file.'''
+        self._tiff_writers[key].close()
+        # TiffWriter does not close file handles it was given, so flush and
+        # close it here.
+        self._files[key].close()
 
     def __enter__(self):
         return self
@@ -329,3 +571,37 @@ def get_prefixed_filename(file_prefix, start_doc, stream_name, field):
         start=start_doc, field=field, stream_name=stream_name)
     filename = f'{templated_file_prefix}{stream_name}-{field}.tiff'
     return filename
+
+
+def _default_tile(shape):
+    '''Return the tile shape for a compressed frame of ``shape``, or None.
+
+    Frames smaller than 1024 x 1024 are not tiled. For larger ones, the
+    largest square tile of 1024, 512 or 256 that divides the frame evenly
+    is used, or 256 if none does, to limit the padding.
+    '''
+    if min(shape) < 1024:
+        return None
+    for size in (1024, 512, 256):
+        if shape[0] % size == 0 and shape[1] % size == 0:
+            return (size, size)
+    return (256, 256)
+
+
+def _check_write_kwargs(kwargs):
+    '''Raise if ``kwargs`` are not accepted by ``TiffWriter.write``.
+
+    This is checked up front because the writes happen later, on another
+    thread. ``data`` and ``contiguous`` are set by the Serializers.
+    '''
+    parameters = inspect.signature(TiffWriter.write).parameters
+    if any(p.kind is p.VAR_KEYWORD for p in parameters.values()):
+        # Older versions of tifffile accept arbitrary metadata kwargs.
+        allowed = set(kwargs)
+    else:
+        allowed = set(parameters)
+    invalid = set(kwargs) - (allowed - {'self', 'data', 'contiguous'})
+    if invalid:
+        raise TypeError(
+            f"Invalid keyword arguments for tifffile.TiffWriter.write: "
+            f"{sorted(invalid)}")
@@ -1,11 +1,16 @@
 import os
+import sys
 from pathlib import Path
 import tifffile
 
+import numpy as np
 from numpy.testing import assert_array_equal
+import pytest
 
+import event_model
 from event_model import DocumentRouter
-from .. import export, get_prefixed_filename
+import suitcase.utils
+from .. import export, get_prefixed_filename, Serializer
 from suitcase.tiff_series.tests.tests import create_expected
 
 
@@ -108,3 +113,177 @@ def test_file_prefix_stream_name_field_formatting(example_data, tmp_path):
     if artifacts:
         unique_actual = {str(artifact) for artifact in artifacts['stream_data']}
         assert unique_actual == fp_collector.expected_file_paths
+
+
+def make_image_docs(num_events, shape=(3, 3), dtype=None):
+    '''Returns the documents of a run with one image per Event.'''
+    run_bundle = event_model.compose_run()
+    data_keys = {'img': {'source': '', 'dtype': 'array', 'shape': list(shape)}}
+    desc_bundle = run_bundle.compose_descriptor(
+        data_keys=data_keys, name='primary')
+    docs = [('start', run_bundle.start_doc),
+            ('descriptor', desc_bundle.descriptor_doc)]
+    for i in range(num_events):
+        event = desc_bundle.compose_event(
+            data={'img': np.full(shape, i, dtype=dtype)}, timestamps={'img': 0},
+            seq_num=i + 1)
+        docs.append(('event', event))
+    return docs
+
+
+def test_compression(tmp_path):
+    '''Checks that compressed frames are still read back as one stack.'''
+    artifacts = export(make_image_docs(3), tmp_path, compression='zlib')
+
+    filename, = artifacts['stream_data']
+    with tifffile.TiffFile(filename) as tif:
+        assert len(tif.pages) == 3
+        assert tif.pages[0].compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+        actual = tif.asarray()
+    expected = np.stack([np.full((3, 3), i) for i in range(3)])
+    assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("shape, tile", [((1024, 1536), (512, 512)),
+                                         ((1000, 1000), None)])
+def test_compression_default_tile(shape, tile, tmp_path):
+    '''Checks that only large compressed frames are tiled by default.'''
+    artifacts = export(make_image_docs(2, shape), tmp_path,
+                       compression='zlib')
+
+    filename, = artifacts['stream_data']
+    with tifffile.TiffFile(filename) as tif:
+        for page in tif.pages:
+            assert page.is_tiled == (tile is not None)
+            if tile is not None:
+                assert (page.tilelength, page.tilewidth) == tile
+        assert tif.asarray().shape == (2, *shape)
+
+
+@pytest.mark.parametrize("dtype", ['uint8', 'int32', 'float32'])
+def test_astype_none(dtype, tmp_path):
+    '''Checks that frames keep their dtype if astype is None.'''
+    artifacts = export(make_image_docs(3, dtype=dtype), tmp_path, astype=None)
+
+    filename, = artifacts['stream_data']
+    actual = tifffile.imread(filename)
+    assert actual.dtype == dtype
+    expected = np.stack([np.full((3, 3), i, dtype=dtype) for i in range(3)])
+    assert_array_equal(actual, expected)
+
+
+def test_empty_event_page(tmp_path):
+    '''Checks that no file is created for an EventPage without images.'''
+    docs = make_image_docs(0)
+    descriptor = docs[1][1]
+    event_page = {'descriptor': descriptor['uid'], 'uid': [], 'time': [],
+                  'seq_num': [], 'data': {'img': []},
+                  'timestamps': {'img': []}, 'filled': {}}
+    artifacts = export(docs + [('event_page', event_page)], tmp_path)
+
+    assert 'stream_data' not in artifacts
+    assert os.listdir(tmp_path) == []
+
+
+def test_export_twice(tmp_path):
+    '''Checks that exporting again with a fixed prefix overwrites the file.'''
+    export(make_image_docs(3), tmp_path, file_prefix='fixed-')
+    artifacts = export(make_image_docs(2), tmp_path, file_prefix='fixed-')
+
+    filename, = artifacts['stream_data']
+    assert tifffile.imread(filename).shape == (2, 3, 3)
+
+
+@pytest.mark.parametrize("kwargs, buffer_size",
+                         [({}, 2**20), ({'bigtiff': True}, 4 * 2**20),
+                          ({'buffer_size': 12345}, 12345),
+                          ({'bigtiff': True, 'buffer_size': 12345}, 12345)])
+def test_buffer_size(kwargs, buffer_size, tmp_path, monkeypatch):
+    '''Checks that files are opened with the requested write buffer size.'''
+    buffer_sizes = []
+
+    def recording_open(*args, buffering=-1, **kwargs):
+        buffer_sizes.append(buffering)
+        return open(*args, buffering=buffering, **kwargs)
+
+    monkeypatch.setattr(sys.modules[Serializer.__module__], 'open',
+                        recording_open, raising=False)
+    export(make_image_docs(3), tmp_path, **kwargs)
+
+    assert buffer_sizes == [buffer_size]
+
+
+def test_memmap_not_copied(tmp_path, monkeypatch):
+    '''Checks that frames from a memmap of the right dtype are not copied.'''
+    written = []
+    write = tifffile.TiffWriter.write
+
+    def recording_write(self, data, *args, **kwargs):
+        written.append(data)
+        return write(self, data, *args, **kwargs)
+
+    monkeypatch.setattr(tifffile.TiffWriter, 'write', recording_write)
+    memmap = np.memmap(tmp_path / 'data.raw', dtype='uint16', mode='w+',
+                       shape=(3, 4, 4))
+    memmap[:] = np.arange(3)[:, np.newaxis, np.newaxis]
+    docs = make_image_docs(3, shape=(4, 4))
+    for (name, doc), frame in zip(docs[2:], memmap):
+        doc['data']['img'] = frame
+
+    serializer = Serializer(tmp_path / 'out')
+    with serializer:
+        for name, doc in docs:
+            serializer(name, doc)
+
+    assert len(written) == 3
+    assert all(np.shares_memory(data, memmap) for data in written)
+    filename, = serializer.artifacts['stream_data']
+    assert_array_equal(tifffile.imread(filename), memmap)
+
+
+def test_write_error_raised_on_close(tmp_path):
+    '''Checks that an error from the writer thread is not lost.'''
+    with pytest.raises(ValueError, match="COMPRESSION"):
+        export(make_image_docs(1), tmp_path, compression='not-a-codec')
+
+
+@pytest.mark.parametrize("kwargs, error", [({}, OSError),
+                                           ({'compression': 'not-a-codec'},
+                                            ValueError)])
+def test_close_error(kwargs, error, tmp_path, monkeypatch):
+    '''Checks that a failed close still closes the manager, and that an
+    earlier write error is raised instead of the close error.'''
+    close_tiff_writer = Serializer._close_tiff_writer
+
+    def failing_close(self, key):
+        close_tiff_writer(self, key)
+        raise OSError("close failed")
+
+    closed = []
+    manager = suitcase.utils.MultiFileManager(tmp_path)
+    close_manager = manager.close
+
+    def recording_close():
+        closed.append(True)
+        close_manager()
+
+    monkeypatch.setattr(manager, 'close', recording_close)
+    monkeypatch.setattr(Serializer, '_close_tiff_writer', failing_close)
+    with pytest.raises(error):
+        export(make_image_docs(2), manager, **kwargs)
+    assert closed == [True]
+
+
+@pytest.mark.parametrize("kwargs", [{'compression': 'zlib'}, {'tile': (16, 16)}])
+def test_imagej_not_contiguous(kwargs, tmp_path):
+    '''Checks that ImageJ stacks that tifffile cannot write are rejected.'''
+    with pytest.raises(ValueError, match="ImageJ"):
+        Serializer(tmp_path, imagej=True, **kwargs)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("kwargs", [{'not_a_kwarg': 1}, {'contiguous': False}])
+def test_invalid_kwargs(kwargs, tmp_path):
+    '''Checks that bad kwargs for TiffWriter.write are rejected up front.'''
+    with pytest.raises(TypeError, match="Invalid keyword arguments"):
+        Serializer(tmp_path, **kwargs)